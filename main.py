@@ -1,30 +1,53 @@
 import os
+import re
 import uuid
+import asyncio
+import hashlib
 import shutil
 import zipfile
-import traceback
-from pathlib import Path
+import logging
+import logging.handlers
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from functools import lru_cache
 from typing import List, Optional
 
 # 🟢 引入 Redis 库
-import redis
+from redis import asyncio as aioredis
+import orjson
 
-from fastapi import FastAPI, UploadFile, Form, HTTPException, File
+from fastapi import FastAPI, UploadFile, Form, HTTPException, File, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from llama_parse import LlamaParse
-from qdrant_client import QdrantClient, models
+from qdrant_client import AsyncQdrantClient, models
 from flashrank import Ranker, RerankRequest
+from fastembed import TextEmbedding
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pydantic import BaseModel
 
+# 🆕 日志：QueueHandler 只把记录放进队列，真正的格式化/写 stderr 在后台线程完成，不阻塞事件循环
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+logger = logging.getLogger("zeabur")
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.propagate = False
+
 # 🆕 LlamaIndex 相关导入
 try:
     from llama_index.core import Document
     from llama_index.core.node_parser import MarkdownElementNodeParser
-    print("✅ LlamaIndex modules imported successfully")
+    logger.info("✅ LlamaIndex modules imported successfully")
     HAS_LLAMAINDEX = True
 except ImportError as e:
-    print(f"⚠️ Warning: LlamaIndex import error: {e}")
-    print("   Will use fallback mode (optimized chunking)")
+    logger.warning("⚠️ Warning: LlamaIndex import error: %s", e)
+    logger.warning("   Will use fallback mode (optimized chunking)")
     HAS_LLAMAINDEX = False
     MarkdownElementNodeParser = None
     Document = None
@@ -33,23 +56,206 @@ except ImportError as e:
 LLAMA_CLOUD_API_KEY = os.getenv("LLAMA_CLOUD_API_KEY")
 QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+# 🆕 默认走 gRPC（protobuf 比 REST/JSON 更省 CPU 和带宽），需要 Qdrant 开放 6334 端口
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() in ("1", "true", "yes")
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", 6334))
 
 # 🟢 Redis 配置
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", None)
 
+# 🆕 并发解析上限（避免压垮 LlamaParse）
+PARSE_CONCURRENCY = int(os.getenv("PARSE_CONCURRENCY", 8))
+
+# 🆕 默认线程池大小（同步的 Qdrant 上传、文件 I/O 等阻塞操作共用）
+THREADPOOL_WORKERS = int(os.getenv("THREADPOOL_WORKERS", 4))
+
+# 🆕 LlamaParse 结果缓存有效期（默认 7 天）
+LLAMAPARSE_CACHE_TTL = int(os.getenv("LLAMAPARSE_CACHE_TTL", 7 * 24 * 3600))
+
+# 🆕 /search 结果缓存有效期（秒）
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 300))
+SEARCH_VERSION_KEY = "search:collection_version"
+
+# 🆕 每批上传到 Qdrant 的点数，以及同时在途的上传请求数
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 128))
+UPSERT_CONCURRENCY = int(os.getenv("UPSERT_CONCURRENCY", 2))
+
+# 🆕 批量导入结束后恢复的 HNSW 索引阈值
+INDEXING_THRESHOLD = int(os.getenv("QDRANT_INDEXING_THRESHOLD", 20000))
+# 🆕 单次上传超过该点数才在导入期间暂停 HNSW 构建
+BULK_INDEXING_MIN_POINTS = int(os.getenv("BULK_INDEXING_MIN_POINTS", 500))
+
+# 🆕 FlashRank 模型（默认的 MiniLM-L-12 已是 INT8 量化版 ONNX）
+RERANK_MODEL = os.getenv("RERANK_MODEL", "ms-marco-MiniLM-L-12-v2")
+# 🆕 重排序输入的最大 token 数：交叉编码器耗时随序列长度超线性增长，256 足以覆盖段落要点
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", 256))
+# 🆕 重排序按长度分桶的批大小：每批只补齐到本批最长段落，减少 padding 上的无效计算
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", 16))
+
+# 🆕 送入重排序的段落最大字符数（模型最多只看 RERANK_MAX_LENGTH 个 token，多余部分只会浪费分词时间）
+MAX_RERANK_CHARS = int(os.getenv("MAX_RERANK_CHARS", 1500))
+# 🆕 重排序候选池上限：防止调用方传入超大 limit / rerank_pool 拖垮 CPU
+MAX_RERANK_POOL = int(os.getenv("MAX_RERANK_POOL", 300))
+# 🆕 /search 单次返回条数上限
+MAX_SEARCH_LIMIT = int(os.getenv("MAX_SEARCH_LIMIT", 50))
+# 🆕 重排序结果缓存：点 ID 按内容寻址，相同查询 + 相同候选集的打分结果可直接复用
+RERANK_CACHE_TTL = int(os.getenv("RERANK_CACHE_TTL", 3600))
+
+# 🆕 向量分数差距超过该阈值时跳过重排序（0 表示只在候选不足 limit 条时跳过）
+RERANK_SKIP_GAP = float(os.getenv("RERANK_SKIP_GAP", 0.05))
+
+# 🆕 检索时 HNSW 的探索宽度，候选只有几十条时 64 已足够
+SEARCH_HNSW_EF = int(os.getenv("SEARCH_HNSW_EF", 64))
+
+EMBED_MODEL = "BAAI/bge-small-zh-v1.5"  # 中文 embedding 模型
+EMBED_DIM = 512  # bge-small-zh-v1.5 的向量维度
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))
+
 COLLECTION_NAME = "telecom_collection_v2"
 TABLES_COLLECTION_NAME = "telecom_tables_v2"  # 🆕 专门存储表格
 
-print(f"DEBUG CONFIG: QDRANT_URL={QDRANT_URL}, REDIS_HOST={REDIS_HOST}")
+logger.info("DEBUG CONFIG: QDRANT_URL=%s, QDRANT_PREFER_GRPC=%s, REDIS_HOST=%s", QDRANT_URL, QDRANT_PREFER_GRPC, REDIS_HOST)
 
 # --- 2. 初始化 Re-ranker ---
-print("⏳ Initializing FlashRank Reranker...")
-reranker = Ranker(model_name="ms-marco-MiniLM-L-12-v2", cache_dir="/tmp/flashrank_cache")
-print("✅ Reranker initialized!")
+logger.info("⏳ Initializing FlashRank Reranker...")
+reranker = Ranker(model_name=RERANK_MODEL, cache_dir="/tmp/flashrank_cache", max_length=RERANK_MAX_LENGTH)
+logger.info("✅ Reranker initialized!")
+
+# 🆕 重排序执行 / 跳过 / 命中缓存次数（每个 worker 各自统计，通过 /stats 查看）
+rerank_stats = {"reranked": 0, "skipped": 0, "cache_hits": 0}
 
-app = FastAPI()
+# 🆕 重排序专用线程池：ONNX 推理本身是多线程的，线程数过多反而互相争抢 CPU
+rerank_executor = ThreadPoolExecutor(max_workers=min(2, os.cpu_count() or 1))
+
+def _rerank_bucketed(query: str, passages: list) -> list:
+    """
+    按段落长度排序后分批重排序：FlashRank 会把一批补齐到最长段落，
+    长度相近的段落放在同一批可以省掉大部分 padding。
+    MiniLM 交叉编码器逐对打分，分批得到的分数可以直接合并排序
+    """
+    ordered = sorted(passages, key=lambda p: len(p["text"]))
+    results = []
+    for start in range(0, len(ordered), RERANK_BATCH_SIZE):
+        batch = ordered[start:start + RERANK_BATCH_SIZE]
+        results.extend(reranker.rerank(RerankRequest(query=query, passages=batch)))
+    results.sort(key=lambda r: r["score"], reverse=True)
+    return results
+
+# --- 3. 初始化 Embedding 模型（入库和查询共用） ---
+logger.info("⏳ Initializing FastEmbed encoder...")
+embedder = TextEmbedding(model_name=EMBED_MODEL)
+logger.info("✅ Encoder initialized!")
+
+def _embed_documents(texts: List[str]) -> List[List[float]]:
+    """批量编码文档（ONNX 按 batch 做矩阵运算，远快于逐条编码）"""
+    return [v.tolist() for v in embedder.embed(texts, batch_size=EMBED_BATCH_SIZE)]
+
+def _embed_queries(queries: List[str]) -> List[List[float]]:
+    """批量编码查询（query_embed 是查询专用入口，模型定义了查询前缀时会自动加上）"""
+    return [v.tolist() for v in embedder.query_embed(queries)]
+
+# 🆕 查询向量微批处理：并发到达的查询在一个很短的窗口内合并成一次 ONNX 推理
+QUERY_CACHE_SIZE = 1024
+QUERY_BATCH_SIZE = int(os.getenv("QUERY_BATCH_SIZE", 32))
+QUERY_BATCH_WINDOW = float(os.getenv("QUERY_BATCH_WINDOW_MS", 5)) / 1000
+QUERY_QUEUE_SIZE = int(os.getenv("QUERY_QUEUE_SIZE", 256))
+# 🆕 查询编码专用线程池：批处理任务本身串行，一个线程即可；
+# 与默认线程池隔离，入库时的文件读写 / 切分占满默认线程池也不会拖慢检索
+query_embed_executor = ThreadPoolExecutor(max_workers=1)
+
+# 查询向量 LRU 缓存：重复查询（重试、翻页、Agent 多轮）无需重新编码；只在事件循环线程中读写
+_query_vectors: "OrderedDict[str, List[float]]" = OrderedDict()
+_query_queue: Optional[asyncio.Queue] = None
+_query_batcher_task: Optional[asyncio.Task] = None
+
+async def _query_embed_batcher():
+    """后台任务：攒够 QUERY_BATCH_SIZE 条或等满 QUERY_BATCH_WINDOW 后统一编码"""
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await _query_queue.get()]
+        deadline = loop.time() + QUERY_BATCH_WINDOW
+        while len(items) < QUERY_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(_query_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        queries = list(dict.fromkeys(q for q, _ in items))
+        try:
+            vectors = dict(zip(
+                queries,
+                await loop.run_in_executor(query_embed_executor, _embed_queries, queries),
+            ))
+        except Exception as e:
+            for _, fut in items:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+
+        for query, vector in vectors.items():
+            _query_vectors[query] = vector
+        while len(_query_vectors) > QUERY_CACHE_SIZE:
+            _query_vectors.popitem(last=False)
+        for query, fut in items:
+            if not fut.done():
+                fut.set_result(vectors[query])
+
+async def _embed_query(query: str) -> List[float]:
+    """获取查询向量：先查本地缓存，未命中时交给微批处理任务；队列满时返回 503"""
+    vector = _query_vectors.get(query)
+    if vector is not None:
+        _query_vectors.move_to_end(query)
+        return vector
+    fut = asyncio.get_running_loop().create_future()
+    try:
+        _query_queue.put_nowait((query, fut))
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Query embedding queue is full, retry later")
+    return await fut
+
+# --- 4. 初始化 LlamaParse（全局复用，连接池跨请求共享） ---
+PARSING_INSTRUCTION = """
+这是一个电信运营商的渠道政策文档，请按以下要求解析：
+
+【表格处理 - 最高优先级】
+1. **必须保留所有表格的完整结构**，包括嵌套表格、合并单元格
+2. **跨页表格必须合并**成一个完整的表格
+3. 表格输出为 Markdown 格式，使用标准语法
+4. **不要遗漏任何数字、金额、百分比**
+5. 保留表格标题和说明文字
+
+【文本处理】
+1. 保留所有业务名称、产品名称、活动名称
+2. 保留关键条款、条件说明、注意事项
+3. 分级标题用 # ## ### 等 Markdown 语法标注
+
+关键原则：宁可保留多余信息，也不要遗漏任何业务规则和数字！
+""".strip()
+
+# 🆕 影响解析结果的配置集中在一处，同时用于构建 parser 和生成缓存键
+LLAMAPARSE_CONFIG = {
+    "result_type": "markdown",
+    "premium_mode": True,
+    "parsing_instruction": PARSING_INSTRUCTION,
+}
+# 修改解析指令或模式后指纹随之变化，旧配置解析出的缓存不会再被命中
+LLAMAPARSE_CONFIG_DIGEST = hashlib.blake2b(
+    orjson.dumps(LLAMAPARSE_CONFIG, option=orjson.OPT_SORT_KEYS), digest_size=8
+).hexdigest()
+
+parser = LlamaParse(
+    api_key=LLAMA_CLOUD_API_KEY,
+    verbose=True,
+    **LLAMAPARSE_CONFIG
+) if LLAMA_CLOUD_API_KEY else None
+
+# 🆕 默认使用 orjson 序列化响应（长中文文本编码更快）
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -62,20 +268,180 @@ if not QDRANT_URL:
     raise ValueError("❌ Fatal Error: QDRANT_URL is missing!")
 
 # 初始化 Qdrant
-client = QdrantClient(
+# 🆕 只使用异步客户端：所有调用都在事件循环内直接 await，不阻塞其他请求
+aclient = AsyncQdrantClient(
     url=QDRANT_URL,
     api_key=QDRANT_API_KEY,
-    prefer_grpc=False
+    prefer_grpc=QDRANT_PREFER_GRPC,
+    grpc_port=QDRANT_GRPC_PORT,
+    timeout=30
+)
+
+# 🟢 初始化 Redis（模块级连接池，所有端点复用）
+# 🆕 使用 redis.asyncio：缓存读写直接 await，Redis 慢或不可达时不会卡住事件循环
+redis_pool = aioredis.ConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    password=REDIS_PASSWORD,
+    decode_responses=True,
+    socket_timeout=3,
+    socket_connect_timeout=3,
+    max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 32))
 )
+redis_client = aioredis.Redis(connection_pool=redis_pool)
+
+# 🆕 已确认存在的集合（本地缓存，省去热路径上的 collection_exists 往返）
+# 每个 worker 各有一份：其他 worker 的 /reset 删掉集合后，这里的记录会过期，
+# 因此所有集合操作遇到"集合不存在"错误时都要经 _forget_collection 移除记录
+_ready_collections: set = set()
+
+async def _collection_ready(name: str) -> bool:
+    """只缓存"存在"的结果；未命中时才向 Qdrant 确认"""
+    if name in _ready_collections:
+        return True
+    if await aclient.collection_exists(name):
+        _ready_collections.add(name)
+        return True
+    return False
+
+def _qdrant_error_is(e: Exception, http_status: int, grpc_code: str) -> bool:
+    """按 REST 状态码或 gRPC 状态名判断 Qdrant 错误类型"""
+    if getattr(e, "status_code", None) == http_status:
+        return True
+    code = getattr(e, "code", None)
+    if callable(code):
+        try:
+            return getattr(code(), "name", None) == grpc_code
+        except Exception:
+            return False
+    return False
+
+def _is_collection_missing(e: Exception) -> bool:
+    """Qdrant 报告集合不存在（REST 返回 404，gRPC 返回 NOT_FOUND）"""
+    return _qdrant_error_is(e, 404, "NOT_FOUND")
+
+def _is_collection_conflict(e: Exception) -> bool:
+    """🆕 Qdrant 报告集合已存在（REST 返回 409，gRPC 返回 ALREADY_EXISTS）"""
+    return _qdrant_error_is(e, 409, "ALREADY_EXISTS")
+
+def _forget_collection(name: str, e: Exception) -> bool:
+    """集合已被删除（可能是其他 worker 的 /reset）时移除本地记录并返回 True"""
+    if not _is_collection_missing(e):
+        return False
+    _ready_collections.discard(name)
+    logger.warning("⚠️ Collection %s no longer exists, dropped from local cache", name)
+    return True
+
+async def _on_collection(name: str, call, default=None):
+    """在集合上执行操作；集合不存在或已被删除时返回 default"""
+    if not await _collection_ready(name):
+        return default
+    try:
+        return await call()
+    except Exception as e:
+        if _forget_collection(name, e):
+            return default
+        raise
+
+# 🆕 需要建立 keyword 索引的 payload 字段（删除、过滤检索时走索引而非全量扫描）
+PAYLOAD_INDEX_FIELDS = ("group_id", "filename", "doc_type", "source_package", "chunk_type")
+
+async def _ensure_payload_indexes(name: str):
+    for field in PAYLOAD_INDEX_FIELDS:
+        try:
+            await aclient.create_payload_index(
+                collection_name=name,
+                field_name=field,
+                field_schema=models.PayloadSchemaType.KEYWORD
+            )
+        except Exception as e:
+            logger.warning("⚠️ Payload index %s.%s skipped: %s", name, field, e)
+
+# 🆕 并发入库的多个文件可能同时发现集合不存在，建集合时串行化
+_collection_lock = asyncio.Lock()
+
+async def _create_collection(name: str):
+    """按统一的存储 / 量化 / HNSW 配置新建集合"""
+    await aclient.create_collection(
+        collection_name=name,
+        # 🆕 向量以 float16 存储，内存和磁盘占用减半，余弦相似度精度损失可忽略；
+        # 原始向量放磁盘，检索走常驻内存的 INT8 量化向量
+        vectors_config=models.VectorParams(
+            size=EMBED_DIM,
+            distance=models.Distance.COSINE,
+            datatype=models.Datatype.FLOAT16,
+            on_disk=True,
+        ),
+        quantization_config=models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, always_ram=True)
+        ),
+        hnsw_config=models.HnswConfigDiff(m=16, ef_construct=128),
+    )
+
+async def _ensure_collection(name: str):
+    """确保集合存在；新建时同时创建 payload 索引"""
+    if await _collection_ready(name):
+        return
+    async with _collection_lock:
+        if await _collection_ready(name):
+            return
+        try:
+            await _create_collection(name)
+        except Exception as e:
+            # 🆕 其他 worker 抢先建好了集合：视为成功，照常补建索引并标记就绪
+            if not _is_collection_conflict(e):
+                raise
+            logger.info("  ℹ️ Collection already exists (created concurrently): %s", name)
+        else:
+            logger.info("  ✅ Created collection: %s", name)
+        await _ensure_payload_indexes(name)
+        _ready_collections.add(name)
 
 @app.on_event("startup")
-def startup_event():
-    print(f"🚀 Connecting to Qdrant at: {QDRANT_URL} ...")
+async def startup_event():
+    # 🆕 显式设置默认线程池（asyncio.to_thread 使用），重排序另有专用线程池
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=THREADPOOL_WORKERS)
+    )
+
+    # 🆕 启动查询向量微批处理任务（队列必须在事件循环内创建）
+    global _query_queue, _query_batcher_task
+    _query_queue = asyncio.Queue(maxsize=QUERY_QUEUE_SIZE)
+    _query_batcher_task = asyncio.create_task(_query_embed_batcher())
+
+    logger.info("🚀 Connecting to Qdrant at: %s ...", QDRANT_URL)
+    try:
+        collections = await aclient.get_collections()
+        _ready_collections.update(c.name for c in collections.collections)
+        logger.info("✅ Connected to Qdrant! Found %s collections.", len(collections.collections))
+
+    except Exception as e:
+        logger.error("❌ Qdrant Connection Failed! Error: %s", e)
+    else:
+        # 🆕 启动时预建集合（显式的 HNSW / 量化配置），已有集合只补建 payload 索引（已存在时 Qdrant 直接忽略）
+        # 每个集合单独处理，一个失败不影响另一个
+        for name in (COLLECTION_NAME, TABLES_COLLECTION_NAME):
+            try:
+                if name in _ready_collections:
+                    await _ensure_payload_indexes(name)
+                else:
+                    await _ensure_collection(name)
+            except Exception as e:
+                logger.error("❌ Collection setup failed for %s: %s", name, e)
+
+    # 🆕 预热 embedding 模型，首次入库/检索不再承担 ONNX 推理冷启动
+    try:
+        _embed_documents(["warmup"])
+        logger.info("✅ Embedder warmed up!")
+    except Exception as e:
+        logger.warning("⚠️ Embedder warmup failed: %s", e)
+
+    # 🆕 预热重排序模型，首个真实查询不再承担 ONNX 会话初始化开销
     try:
-        collections = client.get_collections()
-        print(f"✅ Connected to Qdrant! Found {len(collections.collections)} collections.")
+        reranker.rerank(RerankRequest(query="warmup", passages=[{"id": 0, "text": "warmup"}]))
+        logger.info("✅ Reranker warmed up!")
     except Exception as e:
-        print(f"❌ Qdrant Connection Failed! Error: {e}")
+        logger.warning("⚠️ Reranker warmup failed: %s", e)
 
 @app.get("/")
 def health_check():
@@ -98,15 +464,238 @@ class CompareDocumentsRequest(BaseModel):
 
 # ========== 辅助函数 ==========
 
-def extract_zip(zip_path: str, extract_to: str):
+def _skip_zip_member(name: str) -> bool:
+    """跳过隐藏文件、__MACOSX 元数据以及带 .. 的路径"""
+    parts = [p for p in name.split("/") if p]
+    return not parts or any(p.startswith(".") or p == "__MACOSX" for p in parts)
+
+def extract_zip(zip_path: str, extract_to: str) -> List[str]:
+    """
+    并行解压 ZIP，返回解压出的文件路径列表（调用方无需再遍历目录）。
+    ZipFile 句柄不是线程安全的，因此每个线程独立打开一次 ZipFile，
+    逐个条目以 1MB 缓冲区流式写入最终路径
+    """
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_to)
+        members = [
+            info for info in zip_ref.infolist()
+            if not info.is_dir() and not _skip_zip_member(info.filename)
+        ]
+
+    if not members:
+        return []
+
+    # 预先计算目标路径并一次性创建所有目录，避免各线程重复 makedirs
+    targets = []
+    for info in members:
+        parts = [p for p in info.filename.split("/") if p]
+        targets.append(os.path.join(extract_to, *parts))
+    for d in {os.path.dirname(t) for t in targets}:
+        os.makedirs(d, exist_ok=True)
+
+    jobs = list(zip(members, targets))
+    workers = min(len(jobs), os.cpu_count() or 1)
+
+    def _extract_slice(batch):
+        with zipfile.ZipFile(zip_path, 'r') as zf:
+            for info, target in batch:
+                with zf.open(info, 'r') as src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst, length=1024 * 1024)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(_extract_slice, [jobs[i::workers] for i in range(workers)]))
+
+    return targets
+
+def _save_upload(src, dest_path: str) -> str:
+    """
+    以 1MB 缓冲区把上传流写入磁盘，避免整文件读入内存；
+    🆕 边写边计算 SHA-256 并返回，单文件上传无需为缓存键再读一遍磁盘
+    """
+    digest = hashlib.sha256()
+    with open(dest_path, "wb") as out:
+        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+def _log_rmtree_error(func, path, exc_info):
+    """rmtree 错误处理：目录/文件已不存在时忽略，其余错误（权限、占用等）记录后继续"""
+    if issubclass(exc_info[0], FileNotFoundError):
+        return
+    logger.warning("⚠️ Temp cleanup failed (%s %s): %s", func.__name__, path, exc_info[1])
+
+# 主件关键词预编译为单个正则，一次扫描完成匹配
+_MAIN_DOC_RE = re.compile("|".join(map(re.escape, ["通知", "公告", "管理办法", "规定", "主件", "正文"])))
 
 def guess_doc_type(filename: str) -> str:
-    main_keywords = ["通知", "公告", "管理办法", "规定", "主件", "正文"]
-    if any(k in filename for k in main_keywords):
-        return "main"
-    return "attachment"
+    return "main" if _MAIN_DOC_RE.search(filename) else "attachment"
+
+def _file_sha256(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def _parse_cache_key(content_digest: str) -> str:
+    """按文件内容的 SHA-256 + 解析配置指纹生成 LlamaParse 缓存键"""
+    return f"llamaparse:md:{LLAMAPARSE_CONFIG_DIGEST}:{content_digest}"
+
+async def _cache_get(key: str) -> Optional[str]:
+    """读取 Redis 缓存，Redis 不可用时返回 None"""
+    try:
+        return await redis_client.get(key)
+    except Exception as e:
+        logger.warning("⚠️ Redis cache unavailable: %s", e)
+        return None
+
+async def _cache_setex(key: str, ttl: int, value: str):
+    """写入 Redis 缓存，失败时忽略"""
+    try:
+        await redis_client.setex(key, ttl, value)
+    except Exception as e:
+        logger.warning("⚠️ Redis cache write skipped: %s", e)
+
+async def _search_cache_key(query: str, limit: int, rerank_pool: int) -> Optional[str]:
+    """
+    /search 缓存键：把集合版本号折叠进去，
+    入库/删除/重置时递增版本号即可让旧缓存全部失效
+    """
+    try:
+        version = await redis_client.get(SEARCH_VERSION_KEY) or "0"
+    except Exception as e:
+        logger.warning("⚠️ Redis cache unavailable: %s", e)
+        return None
+    digest = hashlib.blake2b(f"{version}|{query}|{limit}|{rerank_pool}".encode(), digest_size=16).hexdigest()
+    return f"search:{digest}"
+
+def _rerank_cache_key(query: str, point_ids: List[str]) -> str:
+    """重排序缓存键：重排序配置 + 查询 + 排序后的候选点 ID，与集合版本无关"""
+    # 🆕 模型或截断长度变化后分数不再可比，旧缓存不能复用
+    config = f"{RERANK_MODEL}|{RERANK_MAX_LENGTH}|{MAX_RERANK_CHARS}"
+    digest = hashlib.blake2b(
+        f"{config}|{query}|{','.join(sorted(point_ids))}".encode(), digest_size=16
+    ).hexdigest()
+    return f"rerank:{digest}"
+
+async def _bump_collection_version():
+    """集合内容变化后递增版本号，使 /search 缓存失效"""
+    try:
+        await redis_client.incr(SEARCH_VERSION_KEY)
+    except Exception as e:
+        logger.warning("⚠️ Redis version bump skipped: %s", e)
+
+def _point_id(group_id: str, filename: str, text: str) -> str:
+    """
+    按内容寻址的点 ID：同一文档的相同内容总是得到相同 ID，
+    重复入库时不会产生重复数据，未变化的 chunk 也无需重新编码；
+    文档修改后不再出现的旧 chunk 由 /ingest 结束时的 _prune_stale_points 删除
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{group_id}|{filename}|{text}"))
+
+# 🆕 全局限制同时在途的上传批次（Qdrant 在 2 个并发左右吞吐最佳）
+upsert_semaphore = asyncio.Semaphore(UPSERT_CONCURRENCY)
+
+async def _upsert_in_batches(collection_name: str, points: list) -> int:
+    """
+    分批编码并并发上传到 Qdrant（异步客户端，不阻塞事件循环）；
+    🆕 集合在上传途中被其他 worker 的 /reset 删除时，重建集合后重试一次
+    """
+    try:
+        return await _upload_points(collection_name, points)
+    except Exception as e:
+        if not _forget_collection(collection_name, e):
+            raise
+    await _ensure_collection(collection_name)
+    return await _upload_points(collection_name, points)
+
+async def _upload_points(collection_name: str, points: list) -> int:
+    async def _upsert_batch(batch: list):
+        async with upsert_semaphore:
+            # 已入库的 chunk（ID 由内容决定）复用已存向量，无需重新编码；
+            # 仍随本批一起 upsert，使 source_package / doc_type 等 payload 更新为本次入库的值
+            existing = await aclient.retrieve(
+                collection_name=collection_name,
+                ids=[p.id for p in batch],
+                with_payload=False,
+                with_vectors=True
+            )
+            existing_vectors = {str(r.id): r.vector for r in existing}
+            for point in batch:
+                if point.id in existing_vectors:
+                    point.vector = existing_vectors[point.id]
+
+            # 在线程中批量编码本批新文本，随后上传；两批并发时编码与上传相互重叠
+            to_embed = [p for p in batch if p.id not in existing_vectors]
+            if to_embed:
+                vectors = await asyncio.to_thread(
+                    _embed_documents, [p.payload["document"] for p in to_embed]
+                )
+                for point, vector in zip(to_embed, vectors):
+                    point.vector = vector
+            await aclient.upsert(collection_name=collection_name, points=batch)
+
+    if not points:
+        return 0
+
+    # 同一文档内完全相同的 chunk 只保留一份
+    points = list({p.id: p for p in points}.values())
+
+    batches = [
+        _upsert_batch(points[start:start + UPSERT_BATCH_SIZE])
+        for start in range(0, len(points), UPSERT_BATCH_SIZE)
+    ]
+
+    # 🆕 小文档直接上传：频繁切换索引配置反而让 Qdrant 反复重建段
+    if len(points) <= BULK_INDEXING_MIN_POINTS:
+        await asyncio.gather(*batches)
+        return len(points)
+
+    # 导入期间暂停 HNSW 构建（indexing_threshold=0），导入完成后恢复
+    await aclient.update_collection(
+        collection_name=collection_name,
+        optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0)
+    )
+    try:
+        await asyncio.gather(*batches)
+    finally:
+        await aclient.update_collection(
+            collection_name=collection_name,
+            optimizers_config=models.OptimizersConfigDiff(indexing_threshold=INDEXING_THRESHOLD)
+        )
+    return len(points)
+
+# Markdown 表格分隔行，如 |---|、| :---: |、| ===
+_MD_TABLE_SEP_RE = re.compile(r"\|\s*:?(?:-{3,}|={3,})")
+
+# 回退模式切分器（只构建一次）：使用更大的 chunk_size 减少切断表格的概率
+FALLBACK_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=4000,  # 增大到4000
+    chunk_overlap=800,  # 增大 overlap
+    separators=[
+        "\n\n##",
+        "\n\n###",
+        "\n\n",
+        "\n| ",  # 尝试在表格行前切分
+        "\n",
+        "。",
+        " ",
+        ""
+    ],
+)
+
+# 🆕 只检索主集合中表格块的过滤条件（chunk_type 已建 keyword 索引）
+TABLE_CHUNK_FILTER = models.Filter(
+    must=[models.FieldCondition(key="chunk_type", match=models.MatchValue(value="table"))]
+)
+
+# 🆕 MarkdownElementNodeParser 只构建一次，所有文档共用
+NODE_PARSER = MarkdownElementNodeParser(num_workers=4) if HAS_LLAMAINDEX else None
+
+def _parse_nodes(llama_doc):
+    """拆分出文本节点和表格对象"""
+    nodes = NODE_PARSER.get_nodes_from_documents([llama_doc])
+    return NODE_PARSER.get_nodes_and_objects(nodes)
+
+# 🆕 全局限制同时进行的 LlamaParse 请求数（跨所有 /ingest 请求）
+parse_semaphore = asyncio.Semaphore(PARSE_CONCURRENCY)
 
 # ========== 🆕 核心：使用 MarkdownElementNodeParser 处理文档 ==========
 
@@ -114,63 +703,51 @@ async def process_document_with_element_parser(
     file_path: str,
     filename: str,
     group_id: str,
-    source_package: str
+    source_package: str,
+    content_digest: Optional[str] = None
 ) -> dict:
     """
     使用 MarkdownElementNodeParser 处理文档
     分别处理文本节点和表格对象
+    content_digest: 文件内容的 SHA-256（已知时传入，省去再读一遍文件）
     """
-    print(f"📄 Processing: {filename}")
-
-    # 1. 使用 LlamaParse 解析文档
-    parser = LlamaParse(
-        api_key=LLAMA_CLOUD_API_KEY,
-        result_type="markdown",
-        premium_mode=True,
-        verbose=True,
-        parsing_instruction="""
-这是一个电信运营商的渠道政策文档，请按以下要求解析：
-
-【表格处理 - 最高优先级】
-1. **必须保留所有表格的完整结构**，包括嵌套表格、合并单元格
-2. **跨页表格必须合并**成一个完整的表格
-3. 表格输出为 Markdown 格式，使用标准语法
-4. **不要遗漏任何数字、金额、百分比**
-5. 保留表格标题和说明文字
-
-【文本处理】
-1. 保留所有业务名称、产品名称、活动名称
-2. 保留关键条款、条件说明、注意事项
-3. 分级标题用 # ## ### 等 Markdown 语法标注
-
-关键原则：宁可保留多余信息，也不要遗漏任何业务规则和数字！
-        """.strip()
-    )
+    logger.debug("📄 Processing: %s", filename)
 
     try:
-        documents = await parser.aload_data(file_path)
-        if not documents:
-            print(f"⚠️ Warning: No text found in {filename}")
-            return {"success": False, "error": "No documents parsed"}
+        # 🆕 相同内容的文件直接复用缓存的 Markdown，跳过 LlamaParse
+        if content_digest is None:
+            content_digest = await asyncio.to_thread(_file_sha256, file_path)
+        cache_key = _parse_cache_key(content_digest)
+        markdown_text = await _cache_get(cache_key)
+
+        if markdown_text is not None:
+            logger.debug("  ⚡ Parse cache hit: %s", filename)
+        else:
+            async with parse_semaphore:
+                documents = await parser.aload_data(file_path)
+            if not documents:
+                logger.warning("⚠️ Warning: No text found in %s", filename)
+                return {"success": False, "error": "No documents parsed"}
+
+            markdown_text = documents[0].text
+            await _cache_setex(cache_key, LLAMAPARSE_CACHE_TTL, markdown_text)
 
-        markdown_text = documents[0].text
         doc_type = guess_doc_type(filename)
 
         # 🆕 2. 检查是否可用 MarkdownElementNodeParser
         if HAS_LLAMAINDEX:
-            print("  ✨ Using MarkdownElementNodeParser (table extraction mode)")
+            logger.debug("  ✨ Using MarkdownElementNodeParser (table extraction mode)")
             return await _process_with_element_parser(
                 markdown_text, filename, group_id, source_package, doc_type
             )
         else:
-            print("  ⚠️ Using fallback mode (optimized for tables)")
+            logger.debug("  ⚠️ Using fallback mode (optimized for tables)")
             return await _process_with_fallback(
                 markdown_text, filename, group_id, source_package, doc_type
             )
 
     except Exception as e:
-        print(f"❌ Error processing {filename}: {e}")
-        traceback.print_exc()
+        logger.exception("❌ Error processing %s: %s", filename, e)
         return {"success": False, "error": str(e)}
 
 
@@ -183,39 +760,18 @@ async def _process_with_element_parser(
 ) -> dict:
     """使用 MarkdownElementNodeParser 处理（推荐模式）"""
     try:
-        # 使用 MarkdownElementNodeParser 解析
-        node_parser = MarkdownElementNodeParser(
-            num_workers=4,  # 并发处理
-        )
-
         # 创建 LlamaIndex Document 对象
         llama_doc = Document(text=markdown_text, metadata={"filename": filename})
 
-        # 获取节点和对象
-        nodes = node_parser.get_nodes_from_documents([llama_doc])
-        base_nodes, objects = node_parser.get_nodes_and_objects(nodes)
+        # 获取节点和对象（🆕 Markdown 解析是 CPU 密集操作，放到线程中执行）
+        base_nodes, objects = await asyncio.to_thread(_parse_nodes, llama_doc)
 
-        print(f"  📊 Extracted {len(base_nodes)} text nodes")
-        print(f"  📋 Extracted {len(objects)} table objects")
+        logger.debug("  📊 Extracted %s text nodes", len(base_nodes))
+        logger.debug("  📋 Extracted %s table objects", len(objects))
 
         # 🆕 确保集合存在
-        if not client.collection_exists(COLLECTION_NAME):
-            from qdrant_client.models import Distance, VectorParams, CreateCollection
-            client.create_collection(
-                collection_name=COLLECTION_NAME,
-                vectors_config=VectorParams(size=384, distance=Distance.COSINE)  # bge-small-zh-v1.5 的维度
-            )
-            print(f"  ✅ Created collection: {COLLECTION_NAME}")
-
-        if not client.collection_exists(TABLES_COLLECTION_NAME):
-            from qdrant_client.models import Distance, VectorParams
-            client.create_collection(
-                collection_name=TABLES_COLLECTION_NAME,
-                vectors_config=VectorParams(size=384, distance=Distance.COSINE)
-            )
-            print(f"  ✅ Created collection: {TABLES_COLLECTION_NAME}")
-
-        total_stored = 0
+        await _ensure_collection(COLLECTION_NAME)
+        await _ensure_collection(TABLES_COLLECTION_NAME)
 
         # 📌 存储文本节点
         from qdrant_client.models import PointStruct
@@ -225,8 +781,8 @@ async def _process_with_element_parser(
             if node.text.strip():
                 points_to_upload.append(
                     PointStruct(
-                        id=str(uuid.uuid4()),
-                        vector={},  # Qdrant 会自动生成向量
+                        id=_point_id(group_id, filename, node.text),
+                        vector={},  # 向量在上传前由 _upsert_in_batches 批量计算
                         payload={
                             "document": node.text,
                             "group_id": group_id,
@@ -244,8 +800,8 @@ async def _process_with_element_parser(
             if obj.text.strip():
                 points_to_upload.append(
                     PointStruct(
-                        id=str(uuid.uuid4()),
-                        vector={},  # Qdrant 会自动生成向量
+                        id=_point_id(group_id, filename, obj.text),
+                        vector={},  # 向量在上传前由 _upsert_in_batches 批量计算
                         payload={
                             "document": obj.text,
                             "group_id": group_id,
@@ -259,27 +815,22 @@ async def _process_with_element_parser(
                     )
                 )
 
-        # 批量上传
-        if points_to_upload:
-            client.upsert(
-                collection_name=COLLECTION_NAME,
-                points=points_to_upload
-            )
-            total_stored = len(points_to_upload)
+        # 分批上传
+        total_stored = await _upsert_in_batches(COLLECTION_NAME, points_to_upload)
 
-        print(f"  ✅ Stored {total_stored} chunks (text + tables)")
+        logger.debug("  ✅ Stored %s chunks (text + tables)", total_stored)
 
         return {
             "success": True,
             "text_nodes": len(base_nodes),
             "table_objects": len(objects),
             "total_chunks": total_stored,
+            "point_ids": [p.id for p in points_to_upload],
             "mode": "element_parser"
         }
 
     except Exception as e:
-        print(f"❌ Element Parser failed, falling back: {e}")
-        traceback.print_exc()
+        logger.exception("❌ Element Parser failed, falling back: %s", e)
         return await _process_with_fallback(
             markdown_text, filename, group_id, source_package, doc_type
         )
@@ -293,51 +844,28 @@ async def _process_with_fallback(
     doc_type: str
 ) -> dict:
     """回退模式：使用大 chunk_size 保留表格完整性"""
-    from langchain_text_splitters import RecursiveCharacterTextSplitter
-
-    print("  🔄 Using fallback mode (large chunk size)")
+    logger.debug("  🔄 Using fallback mode (large chunk size)")
 
     # 🆕 确保集合存在
-    if not client.collection_exists(COLLECTION_NAME):
-        from qdrant_client.models import Distance, VectorParams
-        client.create_collection(
-            collection_name=COLLECTION_NAME,
-            vectors_config=VectorParams(size=384, distance=Distance.COSINE)
-        )
-        print(f"  ✅ Created collection: {COLLECTION_NAME}")
-
-    # 使用更大的 chunk_size 减少切断表格的概率
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=4000,  # 增大到4000
-        chunk_overlap=800,  # 增大 overlap
-        separators=[
-            "\n\n##",
-            "\n\n###",
-            "\n\n",
-            "\n| ",  # 尝试在表格行前切分
-            "\n",
-            "。",
-            " ",
-            ""
-        ],
-    )
+    await _ensure_collection(COLLECTION_NAME)
 
-    chunks = splitter.split_text(markdown_text)
-    print(f"  📊 Split into {len(chunks)} chunks")
+    # 🆕 切分是 CPU 密集操作，放到线程中执行，不阻塞事件循环
+    chunks = await asyncio.to_thread(FALLBACK_SPLITTER.split_text, markdown_text)
+    logger.debug("  📊 Split into %s chunks", len(chunks))
 
     # 🆕 使用批量上传
     from qdrant_client.models import PointStruct
     points_to_upload = []
 
-    for i, chunk in enumerate(chunks):
-        if chunk.strip():
-            # 检测是否包含表格
-            is_table = "|" in chunk and ("|---" in chunk or "| ===" in chunk)
+    # 🆕 每个 chunk 只扫描一次判断是否含表格（匹配分隔行），结果同时用于 payload 和最终计数
+    verdicts = [bool(_MD_TABLE_SEP_RE.search(chunk)) for chunk in chunks]
 
+    for i, (chunk, is_table) in enumerate(zip(chunks, verdicts)):
+        if chunk.strip():
             points_to_upload.append(
                 PointStruct(
-                    id=str(uuid.uuid4()),
-                    vector={},
+                    id=_point_id(group_id, filename, chunk),
+                    vector={},  # 向量在上传前由 _upsert_in_batches 批量计算
                     payload={
                         "document": chunk,
                         "group_id": group_id,
@@ -351,26 +879,43 @@ async def _process_with_fallback(
                 )
             )
 
-    # 批量上传
-    if points_to_upload:
-        client.upsert(
-            collection_name=COLLECTION_NAME,
-            points=points_to_upload
-        )
-        total_stored = len(points_to_upload)
-    else:
-        total_stored = 0
+    # 分批上传
+    total_stored = await _upsert_in_batches(COLLECTION_NAME, points_to_upload)
 
-    print(f"  ✅ Stored {total_stored} chunks (fallback mode)")
+    logger.debug("  ✅ Stored %s chunks (fallback mode)", total_stored)
 
     return {
         "success": True,
-        "text_nodes": len([c for c in chunks if "|" not in c]),
-        "table_objects": len([c for c in chunks if "|" in c]),
+        "text_nodes": len(verdicts) - sum(verdicts),
+        "table_objects": sum(verdicts),
         "total_chunks": total_stored,
+        "point_ids": [p.id for p in points_to_upload],
         "mode": "fallback"
     }
 
+async def _prune_stale_points(group_id: str, kept_ids: dict):
+    """
+    删除同一 group_id 下这些文件本次入库没有写入的点：
+    文档修改后重新入库时，旧版本中已不存在的 chunk 不再留在检索结果里。
+    失败的文件（以及与其同名的文件）不在 kept_ids 中，其旧数据保持不变
+    """
+    async def _prune(filename: str, ids: set):
+        selector = models.FilterSelector(
+            filter=models.Filter(
+                must=[
+                    models.FieldCondition(key="group_id", match=models.MatchValue(value=group_id)),
+                    models.FieldCondition(key="filename", match=models.MatchValue(value=filename)),
+                ],
+                must_not=[models.HasIdCondition(has_id=list(ids))] if ids else None,
+            )
+        )
+        await _on_collection(
+            COLLECTION_NAME,
+            lambda: aclient.delete(collection_name=COLLECTION_NAME, points_selector=selector),
+        )
+
+    await asyncio.gather(*(_prune(filename, ids) for filename, ids in kept_ids.items()))
+
 # ========== 核心业务端点 ==========
 
 @app.post("/ingest")
@@ -387,19 +932,16 @@ async def ingest_package(file: UploadFile = File(...), package_id: str = Form(No
     upload_path = f"{base_tmp_dir}/{file.filename}"
 
     try:
-        content = await file.read()
-        with open(upload_path, "wb") as f:
-            f.write(content)
+        # 🆕 流式落盘（放到线程中执行，不阻塞事件循环）
+        upload_digest = await asyncio.to_thread(_save_upload, file.file, upload_path)
 
         files_to_process = []
         if file.filename.lower().endswith(".zip"):
-            print(f"📦 Detected ZIP package: {file.filename}")
+            logger.info("📦 Detected ZIP package: %s", file.filename)
             extract_dir = f"{base_tmp_dir}/extracted"
-            extract_zip(upload_path, extract_dir)
-            for root, dirs, files in os.walk(extract_dir):
-                for fname in files:
-                    if fname.startswith(".") or "__MACOSX" in root: continue
-                    files_to_process.append(os.path.join(root, fname))
+            files_to_process.extend(
+                await asyncio.to_thread(extract_zip, upload_path, extract_dir)
+            )
         else:
             files_to_process.append(upload_path)
 
@@ -408,17 +950,34 @@ async def ingest_package(file: UploadFile = File(...), package_id: str = Form(No
         total_table_objects = 0
         processed_files = []
 
-        # 🆕 使用新的 Element Parser 处理每个文件
-        for file_path in files_to_process:
+        # 🆕 并发处理每个文件（LlamaParse 调用由全局信号量限流）
+        results = await asyncio.gather(
+            *[
+                process_document_with_element_parser(
+                    file_path=fp,
+                    filename=os.path.basename(fp),
+                    group_id=group_id,
+                    source_package=file.filename,
+                    # ZIP 内的文件由解压结果各自计算
+                    content_digest=upload_digest if fp == upload_path else None
+                )
+                for fp in files_to_process
+            ],
+            return_exceptions=True
+        )
+
+        # 🆕 每个成功入库的文件本次写入的点 ID（同名文件合并），用于清理旧版本残留的 chunk
+        kept_ids = {}
+        # 🆕 有同名文件失败时不清理该文件名：失败文件的旧 chunk 与成功文件共用同一个 filename
+        failed_names = set()
+
+        for file_path, result in zip(files_to_process, results):
             fname = os.path.basename(file_path)
-            result = await process_document_with_element_parser(
-                file_path=file_path,
-                filename=fname,
-                group_id=group_id,
-                source_package=file.filename
-            )
+            if isinstance(result, Exception):
+                result = {"success": False, "error": str(result)}
 
             if result["success"]:
+                kept_ids.setdefault(fname, set()).update(result.get("point_ids", []))
                 total_text_nodes += result.get("text_nodes", 0)
                 total_table_objects += result.get("table_objects", 0)
                 processed_files.append({
@@ -428,6 +987,7 @@ async def ingest_package(file: UploadFile = File(...), package_id: str = Form(No
                     "table_objects": result.get("table_objects", 0)
                 })
             else:
+                failed_names.add(fname)
                 processed_files.append({
                     "filename": fname,
                     "status": "failed",
@@ -436,6 +996,12 @@ async def ingest_package(file: UploadFile = File(...), package_id: str = Form(No
 
         total_chunks = total_text_nodes + total_table_objects
 
+        if kept_ids:
+            prunable = {name: ids for name, ids in kept_ids.items() if name not in failed_names}
+            if prunable:
+                await _prune_stale_points(group_id, prunable)
+            await _bump_collection_version()
+
         if total_chunks == 0:
             return {
                 "status": "error",
@@ -453,38 +1019,41 @@ async def ingest_package(file: UploadFile = File(...), package_id: str = Form(No
         }
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("❌ Ingest failed")
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        if os.path.exists(base_tmp_dir):
-            shutil.rmtree(base_tmp_dir)
+        # 🆕 直接删除，省去一次 stat；只忽略"不存在"，其他错误记录日志
+        await asyncio.to_thread(shutil.rmtree, base_tmp_dir, onerror=_log_rmtree_error)
+
+@lru_cache(maxsize=1024)
+def _group_selector(group_id: str) -> models.FilterSelector:
+    """按 group_id 删除的选择器（group_id 已建 keyword 索引）；重试同一 ID 时直接复用"""
+    return models.FilterSelector(
+        filter=models.Filter(
+            must=[models.FieldCondition(key="group_id", match=models.MatchValue(value=group_id))]
+        )
+    )
 
 @app.post("/delete")
 async def delete_package(target_id: str = Form(..., description="填入 group_id 或 file_id")):
     """删除文档 - 🆕 同时删除文本和表格"""
     try:
-        # 删除主集合
-        if client.collection_exists(COLLECTION_NAME):
-            client.delete(
-                collection_name=COLLECTION_NAME,
-                points_selector=models.FilterSelector(
-                    filter=models.Filter(
-                        must=[models.FieldCondition(key="group_id", match=models.MatchValue(value=target_id))]
-                    )
-                )
-            )
+        # 过滤条件只构建一次，两个集合共用
+        selector = _group_selector(target_id)
 
-        # 🆕 删除表格集合
-        if client.collection_exists(TABLES_COLLECTION_NAME):
-            client.delete(
-                collection_name=TABLES_COLLECTION_NAME,
-                points_selector=models.FilterSelector(
-                    filter=models.Filter(
-                        must=[models.FieldCondition(key="group_id", match=models.MatchValue(value=target_id))]
-                    )
-                )
+        async def _delete_from(collection_name: str):
+            await _on_collection(
+                collection_name,
+                lambda: aclient.delete(collection_name=collection_name, points_selector=selector),
             )
 
+        # 🆕 主集合与表格集合并发删除，只付一次往返延迟
+        await asyncio.gather(
+            _delete_from(COLLECTION_NAME),
+            _delete_from(TABLES_COLLECTION_NAME)
+        )
+
+        await _bump_collection_version()
         return {"status": "deleted", "target_id": target_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -495,123 +1064,196 @@ async def reset_database():
     一键重置：同时清空 Qdrant（文本+表格）和 Redis
     """
     report = []
+    _ready_collections.clear()
 
     # 1. 清空主集合
     try:
-        client.delete_collection(COLLECTION_NAME)
+        await aclient.delete_collection(COLLECTION_NAME)
         report.append("Qdrant text collection deleted")
     except Exception as e:
         report.append(f"Qdrant text skipped ({str(e)})")
 
     # 🆕 2. 清空表格集合
     try:
-        client.delete_collection(TABLES_COLLECTION_NAME)
+        await aclient.delete_collection(TABLES_COLLECTION_NAME)
         report.append("Qdrant tables collection deleted")
     except Exception as e:
         report.append(f"Qdrant tables skipped ({str(e)})")
 
     # 3. 清空 Redis
     try:
-        r = redis.Redis(
-            host=REDIS_HOST,
-            port=REDIS_PORT,
-            password=REDIS_PASSWORD,
-            decode_responses=True,
-            socket_timeout=3
-        )
-        r.flushdb()
+        await redis_client.flushdb()
         report.append("Redis memory flushed")
     except Exception as e:
-        print(f"❌ Redis Reset Failed: {e}")
+        logger.error("❌ Redis Reset Failed: %s", e)
         report.append(f"Redis failed: {str(e)}")
 
+    await _bump_collection_version()
+
     return {"status": "success", "details": " | ".join(report)}
 
 @app.post("/search")
-async def search_docs(query: str = Form(...), limit: int = 5):
+async def search_docs(
+    query: str = Form(...),
+    limit: int = Query(5, ge=1, le=MAX_SEARCH_LIMIT),
+    rerank_pool: Optional[int] = Query(None, ge=1, le=MAX_RERANK_POOL),
+):
     """
-    🆕 搜索接口 - 同时搜索文本和表格
+    🆕 搜索接口 - 按查询意图检索文本或表格块
     使用 query_points 替代已弃用的 query 方法
+    rerank_pool: 文本集合的候选数（表格集合取一半），默认 max(40, limit * 8)，需要更高召回时可调大到 100
     """
     try:
-        all_results = []
-
-        # 🆕 使用中文 embedding 模型
-        from qdrant_client.models import Document
-
-        # 1. 搜索文本集合
-        if client.collection_exists(COLLECTION_NAME):
-            print(f"🔎 Searching text collection for: {query}")
-            text_results = client.query_points(
-                collection_name=COLLECTION_NAME,
-                query=Document(text=query, model="BAAI/bge-small-zh-v1.5"),  # 🆕 中文模型
-                limit=200,
-                with_payload=True,
+        # 🆕 重排序候选池：交叉编码器耗时与候选数成正比，召回在几十条内已饱和
+        if rerank_pool is None:
+            rerank_pool = max(40, limit * 8)
+        rerank_pool = min(max(rerank_pool, limit), MAX_RERANK_POOL)
+
+        # 🆕 命中缓存直接返回，跳过检索和重排序
+        cache_key = await _search_cache_key(query, limit, rerank_pool)
+        if cache_key:
+            cached = await _cache_get(cache_key)
+            if cached is not None:
+                # 缓存内容本身就是 JSON，直接返回，无需反序列化再编码
+                return Response(content=cached, media_type="application/json")
+
+        # 🆕 重排序候选按"结构数组"组织：passages 只带重排序需要的 id/text，
+        # payload 放在按下标对齐的 metas 中，重排后按 id（即下标）取回
+        passages = []
+        metas = []
+        point_ids = []
+        vector_scores = []
+
+        # 🆕 查询向量只计算一次，文本和表格集合共用
+        query_vector = await _embed_query(query)
+
+        # 🆕 文本和表格两个集合互不依赖，用异步客户端并发检索
+        async def _query(collection_name: str, limit: int, query_filter: Optional[models.Filter] = None):
+            result = await _on_collection(
+                collection_name,
+                lambda: aclient.query_points(
+                    collection_name=collection_name,
+                    query=query_vector,
+                    query_filter=query_filter,
+                    limit=limit,
+                    with_payload=True,
+                    search_params=models.SearchParams(hnsw_ef=SEARCH_HNSW_EF, exact=False),
+                ),
             )
-
-            for res in text_results.points:
-                # 🆕 从 payload 中提取数据
-                all_results.append({
-                    "id": str(res.id),
-                    "text": res.payload.get("document", ""),
-                    "meta": res.payload,
-                    "source": "text",
-                    "score": res.score  # 🆕 直接使用返回的 score
-                })
-
-        # 2. 🆕 搜索表格集合（重点！）
-        if client.collection_exists(TABLES_COLLECTION_NAME):
-            print(f"📋 Searching tables collection for: {query}")
-            table_results = client.query_points(
-                collection_name=TABLES_COLLECTION_NAME,
-                query=Document(text=query, model="BAAI/bge-small-zh-v1.5"),  # 🆕 中文模型
-                limit=100,
-                with_payload=True,
+            return result.points if result is not None else []
+
+        # 🆕 按查询意图缩小检索范围：入库时表格与文本都写入主集合（chunk_type 区分），
+        # 表格意图只检索主集合中的表格块（外加表格集合）；其余查询只检索主集合
+        categories = _classify_query(query)
+        if "table" in categories and "comparison" not in categories:
+            logger.debug("📋 Searching table chunks for: %s", query)
+            text_points, table_points = await asyncio.gather(
+                _query(COLLECTION_NAME, rerank_pool, TABLE_CHUNK_FILTER),
+                _query(TABLES_COLLECTION_NAME, max(1, rerank_pool // 2)),
             )
+            if not text_points and not table_points:
+                # 没有表格块时退回普通检索，避免意图误判导致空结果
+                text_points = await _query(COLLECTION_NAME, rerank_pool)
+        else:
+            logger.debug("🔎 Searching text collection for: %s", query)
+            text_points, table_points = await _query(COLLECTION_NAME, rerank_pool), []
 
-            for res in table_results.points:
-                # 🆕 从 payload 中提取数据
-                all_results.append({
-                    "id": str(res.id),
-                    "text": res.payload.get("document", ""),
-                    "meta": res.payload,
-                    "source": "table",
-                    "score": res.score
-                })
+        for res in text_points + table_points:
+            passages.append({"id": len(metas), "text": res.payload.get("document", "")[:MAX_RERANK_CHARS]})
+            metas.append(res.payload)
+            point_ids.append(str(res.id))
+            vector_scores.append(res.score)
 
-        if not all_results:
+        if not passages:
             return []
 
-        print(f"  📊 Found {len(all_results)} results (text + tables)")
+        logger.debug("  📊 Found %s results (text + tables)", len(passages))
 
         # 3. 重排序（FlashRank）- 仍然有用，可以进一步优化结果
-        passages = [
-            {"id": r["id"], "text": r["text"], "meta": r["meta"]}
-            for r in all_results
-        ]
-
-        rerank_request = RerankRequest(query=query, passages=passages)
-        ranked_results = reranker.rerank(rerank_request)
+        # 🆕 候选不超过 limit 条，或第 limit 名与第 limit+1 名的向量分数已拉开足够差距时，
+        # 说明向量检索已足够有把握，直接按向量分数返回，省掉一次交叉编码器推理
+        by_vector = sorted(range(len(metas)), key=lambda i: vector_scores[i], reverse=True)
+        if len(by_vector) <= limit or (
+            RERANK_SKIP_GAP > 0
+            and vector_scores[by_vector[limit - 1]] - vector_scores[by_vector[limit]] > RERANK_SKIP_GAP
+        ):
+            ranking = [(i, vector_scores[i]) for i in by_vector]
+            scored_by = "vector"
+            rerank_stats["skipped"] += 1
+        else:
+            scored_by = "rerank"
+            # 🆕 先查重排序缓存：集合版本变化后 /search 缓存失效，但候选集往往不变
+            rerank_key = _rerank_cache_key(query, point_ids)
+            cached_ranking = await _cache_get(rerank_key)
+            if cached_ranking is not None:
+                index_of = {pid: i for i, pid in enumerate(point_ids)}
+                ranking = [(index_of[pid], score) for pid, score in orjson.loads(cached_ranking)]
+                rerank_stats["cache_hits"] += 1
+            else:
+                # 🆕 CPU 密集的重排序放到线程池中执行，不阻塞事件循环
+                loop = asyncio.get_running_loop()
+                ranked_results = await loop.run_in_executor(
+                    rerank_executor, _rerank_bucketed, query, passages
+                )
+                ranking = [(res["id"], float(res["score"])) for res in ranked_results]
+                rerank_stats["reranked"] += 1
+                await _cache_setex(
+                    rerank_key,
+                    RERANK_CACHE_TTL,
+                    orjson.dumps([[point_ids[i], score] for i, score in ranking]).decode(),
+                )
 
-        top_results = ranked_results[:limit]
+        top_results = ranking[:limit]
 
         # 4. 🆕 在结果中标注来源
-        return [
+        # score 的量纲取决于 scored_by（FlashRank 相关度 / 余弦相似度），vector_score 始终是余弦相似度
+        response = [
             {
-                "content": res["text"],
-                "score": float(res["score"]),
-                "metadata": res["meta"],
-                "content_type": "table" if res["meta"].get("is_table") else "text"
+                "content": metas[i].get("document", ""),
+                "score": score,
+                "scored_by": scored_by,
+                "vector_score": vector_scores[i],
+                "metadata": metas[i],
+                "content_type": "table" if metas[i].get("is_table") else "text"
             }
-            for res in top_results
+            for i, score in top_results
         ]
 
+        if cache_key:
+            await _cache_setex(cache_key, SEARCH_CACHE_TTL, orjson.dumps(response).decode())
+
+        return response
+
+    except HTTPException:
+        raise
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("❌ Search failed")
         raise HTTPException(status_code=500, detail=str(e))
 
 # ========== 🆕 Agentic RAG 增强端点 ==========
 
+def _keyword_re(words: List[str]) -> "re.Pattern":
+    return re.compile("|".join(map(re.escape, words)))
+
+# 查询分析关键词（模块加载时编译一次）
+_QUERY_KEYWORDS = {
+    "comparison": ["对比", "差异", "变化", "vs", "区别"],
+    "aggregation": ["总计", "统计", "汇总", "平均", "求和"],
+    "multi_year": ["2023", "2024", "2022", "2025", "历年", "逐年"],
+    "table": ["表格", "excel", "附件", "sheet", "明细"],
+    "calculation": ["计算", "激励", "提成", "金额", "费用", "合计"],
+}
+# 🆕 所有类别合并为一个带命名分组的正则，一次扫描得到全部命中类别；
+# 放在零宽前瞻里，跨类别重叠的关键词（如"总计算"中的"总计"和"计算"）也都能命中
+_QUERY_CATEGORY_RE = re.compile(
+    "(?=" + "|".join(f"(?P<{name}>{_keyword_re(words).pattern})" for name, words in _QUERY_KEYWORDS.items()) + ")"
+)
+_YEAR_RE = _keyword_re(["2022", "2023", "2024", "2025"])
+
+def _classify_query(query: str) -> set:
+    """返回查询命中的关键词类别（comparison / aggregation / multi_year / table / calculation）"""
+    return {m.lastgroup for m in _QUERY_CATEGORY_RE.finditer(query.lower())}
+
 @app.post("/analyze_query")
 async def analyze_query(request: QueryAnalysisRequest):
     """分析查询复杂度，返回执行计划"""
@@ -625,18 +1267,13 @@ async def analyze_query(request: QueryAnalysisRequest):
         "suggested_approach": "single_step"
     }
 
-    # 检测关键词
-    comparison_keywords = ["对比", "差异", "变化", "vs", "区别"]
-    aggregation_keywords = ["总计", "统计", "汇总", "平均", "求和"]
-    multi_year_keywords = ["2023", "2024", "2022", "2025", "历年", "逐年"]
-    table_keywords = ["表格", "excel", "附件", "sheet", "明细"]
-    calculation_keywords = ["计算", "激励", "提成", "金额", "费用", "合计"]
-
-    has_comparison = any(kw in query for kw in comparison_keywords)
-    has_aggregation = any(kw in query for kw in aggregation_keywords)
-    has_multi_year = any(kw in query for kw in multi_year_keywords)
-    has_table = any(kw in query for kw in table_keywords)
-    has_calculation = any(kw in query for kw in calculation_keywords)
+    # 检测关键词（单个预编译正则，一次扫描）
+    categories = _classify_query(query)
+    has_comparison = "comparison" in categories
+    has_aggregation = "aggregation" in categories
+    has_multi_year = "multi_year" in categories
+    has_table = "table" in categories
+    has_calculation = "calculation" in categories
 
     # 分类逻辑
     if has_comparison and has_multi_year:
@@ -645,10 +1282,7 @@ async def analyze_query(request: QueryAnalysisRequest):
         analysis["suggested_approach"] = "parallel"
         analysis["reasoning"] = "检测到跨年度对比查询，需要分别检索各年度文档"
 
-        years_found = []
-        for year in ["2022", "2023", "2024", "2025"]:
-            if year in query:
-                years_found.append(year)
+        years_found = sorted(set(_YEAR_RE.findall(query)))
 
         if years_found:
             base_query = request.query
@@ -676,7 +1310,7 @@ async def analyze_query(request: QueryAnalysisRequest):
             analysis["sub_queries"] = sub_questions
 
     else:
-        analysis["reasoning"] = "简单查询，将同时搜索文本和表格"
+        analysis["reasoning"] = "简单查询，只检索主集合（表格类查询才会检索表格块）"
 
     return analysis
 
@@ -688,20 +1322,25 @@ async def extract_tables(request: ExtractTableRequest):
     doc_id = request.document_id
 
     try:
-        if not client.collection_exists(TABLES_COLLECTION_NAME):
+        # 搜索表格集合（🆕 本地编码查询向量后直接按向量检索，不再走 client.query 的隐式 embedding）
+        query_vector = await _embed_query(doc_id)
+        result = await _on_collection(
+            TABLES_COLLECTION_NAME,
+            lambda: aclient.query_points(
+                collection_name=TABLES_COLLECTION_NAME,
+                query=query_vector,
+                limit=100,
+                with_payload=True,
+            ),
+        )
+        if result is None:
             return {
                 "document_id": doc_id,
                 "table_count": 0,
                 "tables": [],
                 "error": "Tables collection not found"
             }
-
-        # 搜索表格集合
-        search_result = client.query(
-            collection_name=TABLES_COLLECTION_NAME,
-            query_text=doc_id,
-            limit=100
-        )
+        search_result = result.points
 
         if not search_result:
             return {
@@ -713,12 +1352,13 @@ async def extract_tables(request: ExtractTableRequest):
 
         tables = []
         for res in search_result:
+            document = res.payload.get("document", "")
             tables.append({
-                "content": res.document,
-                "source": res.metadata.get("filename", "unknown"),
+                "content": document,
+                "source": res.payload.get("filename", "unknown"),
                 "chunk_id": str(res.id),
-                "table_index": res.metadata.get("table_index", 0),
-                "row_count": res.document.count("\n") + 1
+                "table_index": res.payload.get("table_index", 0),
+                "row_count": document.count("\n") + 1
             })
 
         return {
@@ -728,8 +1368,10 @@ async def extract_tables(request: ExtractTableRequest):
             "tables": tables[:10]
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("❌ Extract tables failed")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/compare_documents")
@@ -738,28 +1380,34 @@ async def compare_documents(request: CompareDocumentsRequest):
     doc_ids = request.doc_ids
     results = {}
 
+    async def _samples(collection_name: str, query_vector: list) -> List[str]:
+        # 只展示前 3 条样本，无需多取
+        result = await _on_collection(
+            collection_name,
+            lambda: aclient.query_points(
+                collection_name=collection_name,
+                query=query_vector,
+                limit=3,
+                with_payload=True,
+            ),
+        )
+        if result is None:
+            return []
+        return [res.payload.get("document", "") for res in result.points]
+
+    async def _compare_one(doc_id: str):
+        query_vector = await _embed_query(doc_id)
+        # 搜索主集合 / 搜索表格集合
+        return await asyncio.gather(
+            _samples(COLLECTION_NAME, query_vector),
+            _samples(TABLES_COLLECTION_NAME, query_vector),
+        )
+
     try:
-        for doc_id in doc_ids:
-            # 搜索主集合
-            text_results = []
-            if client.collection_exists(COLLECTION_NAME):
-                text_search = client.query(
-                    collection_name=COLLECTION_NAME,
-                    query_text=doc_id,
-                    limit=30
-                )
-                text_results = [res.document for res in text_search[:3]]
-
-            # 搜索表格集合
-            table_results = []
-            if client.collection_exists(TABLES_COLLECTION_NAME):
-                table_search = client.query(
-                    collection_name=TABLES_COLLECTION_NAME,
-                    query_text=doc_id,
-                    limit=30
-                )
-                table_results = [res.document for res in table_search[:3]]
+        # 🆕 所有文档、两个集合的检索并发执行，总延迟约等于一次往返
+        pairs = await asyncio.gather(*(_compare_one(doc_id) for doc_id in doc_ids))
 
+        for doc_id, (text_results, table_results) in zip(doc_ids, pairs):
             results[doc_id] = {
                 "text_chunks": len(text_results),
                 "table_chunks": len(table_results),
@@ -772,8 +1420,10 @@ async def compare_documents(request: CompareDocumentsRequest):
             "summary": f"对比了 {len(doc_ids)} 个文档"
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("❌ Compare documents failed")
         raise HTTPException(status_code=500, detail=str(e))
 
 # ========== 🆕 统计信息端点 ==========
@@ -786,8 +1436,8 @@ async def get_stats():
     }
 
     # 主集合统计
-    if client.collection_exists(COLLECTION_NAME):
-        collection_info = client.get_collection(COLLECTION_NAME)
+    collection_info = await _on_collection(COLLECTION_NAME, lambda: aclient.get_collection(COLLECTION_NAME))
+    if collection_info is not None:
         stats["collections"]["text"] = {
             "name": COLLECTION_NAME,
             "points_count": collection_info.points_count,
@@ -797,8 +1447,8 @@ async def get_stats():
         stats["collections"]["text"] = {"status": "not_created"}
 
     # 表格集合统计
-    if client.collection_exists(TABLES_COLLECTION_NAME):
-        collection_info = client.get_collection(TABLES_COLLECTION_NAME)
+    collection_info = await _on_collection(TABLES_COLLECTION_NAME, lambda: aclient.get_collection(TABLES_COLLECTION_NAME))
+    if collection_info is not None:
         stats["collections"]["tables"] = {
             "name": TABLES_COLLECTION_NAME,
             "points_count": collection_info.points_count,
@@ -807,11 +1457,14 @@ async def get_stats():
     else:
         stats["collections"]["tables"] = {"status": "not_created"}
 
+    # 🆕 当前 worker 的重排序执行 / 跳过 / 命中缓存次数
+    stats["rerank"] = dict(rerank_stats)
+
     return stats
 
 # ========== 端点总结 ==========
 # /ingest       - 🆕 文档入库（使用 MarkdownElementNodeParser）
-# /search       - 🆕 搜索（同时搜索文本和表格）
+# /search       - 🆕 搜索（按查询意图检索主集合，表格类查询检索表格块）
 # /delete       - 删除文档（同时删除文本和表格）
 # /reset        - 重置数据库（文本+表格+Redis）
 # /stats        - 🆕 统计信息
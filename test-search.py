@@ -3,9 +3,8 @@
 测试脚本：检查文档是否在知识库中
 """
 
-import os
-import requests
-import json
+import asyncio
+import httpx
 
 # 配置
 API_URL = "http://elecom-ingest-api:8080"  # 如果在本地测试，改为实际地址
@@ -21,23 +20,36 @@ test_queries = [
     "渠道产品政策"
 ]
 
-print("=" * 60)
-print("🔍 知识库检索测试")
-print("=" * 60)
-print()
-
-for query in test_queries:
-    print(f"📝 查询: {query}")
-    print("-" * 60)
 
+async def search(client: httpx.AsyncClient, query: str):
+    """发送单个查询，异常作为结果返回，便于按顺序统一打印"""
     try:
-        response = requests.post(
+        return await client.post(
             SEARCH_ENDPOINT,
             data={"query": query, "limit": 5},
             headers={"Content-Type": "application/x-www-form-urlencoded"}
         )
+    except Exception as e:
+        return e
+
+
+async def main():
+    print("=" * 60)
+    print("🔍 知识库检索测试")
+    print("=" * 60)
+    print()
 
-        if response.status_code == 200:
+    # 🆕 所有查询并发发出，总耗时取决于最慢的一条而不是所有查询之和
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=20)) as client:
+        responses = await asyncio.gather(*[search(client, q) for q in test_queries])
+
+    for query, response in zip(test_queries, responses):
+        print(f"📝 查询: {query}")
+        print("-" * 60)
+
+        if isinstance(response, Exception):
+            print(f"❌ 错误: {response}")
+        elif response.status_code == 200:
             results = response.json()
 
             if len(results) == 0:
@@ -57,8 +69,9 @@ for query in test_queries:
             print(f"❌ 请求失败: {response.status_code}")
             print(response.text)
 
-    except Exception as e:
-        print(f"❌ 错误: {e}")
+        print("=" * 60)
+        print()
 
-    print("=" * 60)
-    print()
+
+if __name__ == "__main__":
+    asyncio.run(main())